@@ -2,5 +2,14 @@
 """
 from . import gitapi as _gitapi
 Repo = _gitapi.Repo
+Ref = _gitapi.Ref
+Progress = _gitapi.Progress
+MergeResult = _gitapi.MergeResult
+Conflict = _gitapi.Conflict
+Submodule = _gitapi.Submodule
+SubmoduleError = _gitapi.SubmoduleError
+RefTransaction = _gitapi.RefTransaction
+MaintenanceScheduler = _gitapi.MaintenanceScheduler
+GitException = _gitapi.GitException
 git_clone = Repo.git_clone
 git_command = Repo.command
\ No newline at end of file
@@ -0,0 +1,96 @@
+"""Startup benchmarks for gitapi.
+Measures importing the module, opening many repositories and running the
+first query on them. The first query on a plain Repo, which does not
+validate its path, is the baseline; Repo.open adds validation at little
+cost, where validating by running git doubles it. Run from the top
+directory with::
+
+  python -m gitapi.benchgitapi [repo count]
+"""
+from __future__ import print_function
+import os, shutil, subprocess, sys, tempfile
+from timeit import default_timer as timer
+import gitapi
+
+TOP = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _timed(func, runs=1):
+    start = timer()
+    for i in range(runs):
+        func()
+    return (timer() - start) / runs
+
+
+def _python(code):
+    return lambda: subprocess.check_call([sys.executable, "-c", code],
+                                         cwd=TOP)
+
+
+def bench_import(runs=10):
+    """Time for a fresh interpreter to import gitapi, and to import the
+    modules gitapi defers until the first Revision is parsed"""
+    bare = _timed(_python("pass"), runs)
+    return {"import gitapi": _timed(_python("import gitapi"), runs) - bare,
+            "import json, urllib.parse (deferred)": _timed(
+                _python("import json, urllib.parse"), runs) - bare}
+
+
+def bench_open(paths):
+    """Time to open every repo in paths and validate it, by running git
+    or by discovery, and to open and run a first query, with and without
+    validation"""
+    def validate_git():
+        for path in paths:
+            gitapi.Repo(path).git_command("rev-parse", "--git-dir")
+    def validate_discover():
+        for path in paths:
+            gitapi.Repo.open(path)
+    def query():
+        for path in paths:
+            gitapi.Repo(path).git_id()
+    def validate_git_query():
+        for path in paths:
+            repo = gitapi.Repo(path)
+            repo.git_command("rev-parse", "--git-dir")
+            repo.git_id()
+    def validate_discover_query():
+        for path in paths:
+            gitapi.Repo.open(path).git_id()
+    return {"validate, git rev-parse": _timed(validate_git),
+            "validate, Repo.open": _timed(validate_discover),
+            "first query, unvalidated Repo": _timed(query),
+            "first query, validated by git": _timed(validate_git_query),
+            "first query, validated by open": _timed(
+                validate_discover_query)}
+
+
+def make_repos(root, count):
+    """Create count repositories with one commit each in root"""
+    paths = []
+    for i in range(count):
+        path = os.path.join(root, "repo%d" % i)
+        os.mkdir(path)
+        repo = gitapi.Repo(path)
+        repo.git_init()
+        repo.git_command("-c", "user.name=bench", "-c",
+                         "user.email=bench@example.com",
+                         "commit", "--allow-empty", "-m", "bench")
+        paths.append(path)
+    return paths
+
+
+def main(count=50):
+    root = tempfile.mkdtemp()
+    try:
+        paths = make_repos(root, count)
+        results = bench_import()
+        results.update(bench_open(paths))
+    finally:
+        shutil.rmtree(root)
+    for name in sorted(results):
+        print("%-40s %8.2f ms" % (name, results[name] * 1000))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -1,16 +1,15 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function, unicode_literals, with_statement
 from subprocess import Popen, STDOUT, PIPE
-try:
-    from urllib import unquote
-except: #python 3
-    from urllib.parse import unquote
 import re
+import os
 import os.path
-try:
-    import json #for reading logs
-except:
-    import simplejson as json
+import time
+import threading
+
+
+_status_split = re.compile(r"^(\S+)\s+(.*)$")
+_gitfile = re.compile(r"^gitdir: (.*?)\s*$")
 
 
 class GitException(Exception):
@@ -21,6 +20,136 @@ class GitException(Exception):
         self.exit_code = exit_code
 
 
+def _common_dir(git_dir):
+    """Get the directory holding objects and refs for git_dir"""
+    try:
+        with open(os.path.join(git_dir, "commondir")) as commondir:
+            return os.path.normpath(os.path.join(git_dir,
+                                                 commondir.read().strip()))
+    except (IOError, OSError):
+        return git_dir
+
+
+def _mtime(path):
+    """Get the modification time of path, or None if it does not exist"""
+    try:
+        return os.path.getmtime(path)
+    except (IOError, OSError):
+        return None
+
+
+def _is_git_dir(path):
+    """Check if path looks like a git directory, as git itself does"""
+    if not os.path.isfile(os.path.join(path, "HEAD")):
+        return False
+    common = _common_dir(path)
+    return (os.path.isdir(os.path.join(common, "objects"))
+            and os.path.isdir(os.path.join(common, "refs")))
+
+
+def _parallel(func, items, jobs):
+    """Call func on each item in items using at most jobs threads, and
+    return the results in order. Raises the first exception raised by
+    func, after all calls have finished."""
+    items = list(items)
+    results = [None] * len(items)
+    errors = []
+    lock = threading.Lock()
+    remaining = iter(range(len(items)))
+    def worker():
+        while True:
+            with lock:
+                index = next(remaining, None)
+            if index is None:
+                return
+            try:
+                results[index] = func(items[index])
+            except Exception as exc:
+                with lock:
+                    errors.append((index, exc))
+    threads = [threading.Thread(target=worker)
+               for i in range(max(1, min(jobs, len(items))))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise min(errors, key=lambda error: error[0])[1]
+    return results
+
+
+class SubmoduleError(GitException):
+    """Exception raised by recursive submodule operations when the
+    operation failed in some repos. results maps submodule path, or ''
+    for the superproject, to the result for every repo that succeeded,
+    and errors maps path to the exception for every repo that failed."""
+    def __init__(self, results, errors):
+        super(SubmoduleError, self).__init__(
+            "Failed in %s:\n%s" % (", ".join(sorted(errors)), "\n".join(
+                "%s: %s" % (path, errors[path]) for path in sorted(errors))))
+        self.results = results
+        self.errors = errors
+
+
+class Progress(object):
+    """A progress event parsed from the --progress output of git.
+    Available fields are::
+
+      phase, percent, current, total, bytes, throughput, done, remote
+
+    phase is e.g. 'Receiving objects', current and total are object counts
+    (total is None when git does not know it), bytes is the amount
+    transferred and throughput the transfer rate in bytes per second, or
+    None when not reported. remote is true for progress reported by
+    the other side of the connection.
+    """
+    pattern = re.compile(r"^(remote: )?([A-Za-z][A-Za-z ]*?):\s+"
+                         r"(?:(\d+)% \((\d+)/(\d+)\)|(\d+))"
+                         r"(?:, ([\d.]+) (bytes|[KMGT]iB)"
+                         r"(?: \| ([\d.]+) (bytes|[KMGT]iB)/s)?)?"
+                         r"(, done\.)?")
+    units = {"bytes": 1, "KiB": 1 << 10, "MiB": 1 << 20,
+             "GiB": 1 << 30, "TiB": 1 << 40}
+
+    def __init__(self, phase, percent=None, current=0, total=None,
+                 bytes=None, throughput=None, done=False, remote=False):
+        self.phase = phase
+        self.percent = percent
+        self.current = current
+        self.total = total
+        self.bytes = bytes
+        self.throughput = throughput
+        self.done = done
+        self.remote = remote
+
+    @classmethod
+    def parse(cls, line):
+        """Create a Progress object from a line of git output, or return
+        None if it is not a progress line"""
+        match = cls.pattern.match(line.strip())
+        if not match:
+            return None
+        (remote, phase, percent, current, total, count,
+         size, unit, rate, rate_unit, done) = match.groups()
+        if count is not None:
+            current = count
+        return cls(phase, percent=int(percent) if percent else None,
+                   current=int(current),
+                   total=int(total) if total else None,
+                   bytes=cls._bytes(size, unit),
+                   throughput=cls._bytes(rate, rate_unit),
+                   done=bool(done), remote=bool(remote))
+
+    @classmethod
+    def _bytes(cls, value, unit):
+        if value is None:
+            return None
+        return int(float(value) * cls.units[unit])
+
+    def __repr__(self):
+        return "<Progress %s %s/%s>" % (self.phase, self.current, self.total)
+
+
 class Revision(object):
     """A representation of a revision.
     Available fields are::
@@ -31,6 +160,14 @@ class Revision(object):
     """
     def __init__(self, json_log):
         """Create a Revision object from a JSON representation"""
+        try:
+            import json #for reading logs
+        except ImportError:
+            import simplejson as json
+        try:
+            from urllib import unquote
+        except ImportError: #python 3
+            from urllib.parse import unquote
         rev = json.loads(json_log)
 
         for key in rev.keys():
@@ -46,6 +183,238 @@ class Revision(object):
         return self.node == other.node
 
 
+class Ref(object):
+    """A representation of a ref as listed by git for-each-ref.
+    Available fields are::
+
+      name, node, peeled, date, desc
+
+    name is the full ref name, node the object the ref points to and
+    peeled the commit it resolves to - these differ only for annotated
+    tags. date is the committer date of the peeled commit, desc the
+    subject of the tag message for annotated tags, otherwise of the commit.
+
+    A Ref object is equal to any other object with the same name and node
+    """
+    def __init__(self, fields):
+        """Create a Ref object from a dict of for-each-ref fields"""
+        peeled_date = fields.pop("peeled_date", None)
+        for key in fields:
+            self.__setattr__(key, fields[key])
+        if self.peeled:
+            self.date = peeled_date
+        else:
+            self.peeled = self.node
+
+    @property
+    def short_name(self):
+        """The name without the refs/heads/, refs/tags/ or refs/ prefix"""
+        for prefix in ("refs/heads/", "refs/tags/", "refs/"):
+            if self.name.startswith(prefix):
+                return self.name[len(prefix):]
+        return self.name
+
+    def __eq__(self, other):
+        """Returns true if self.name == other.name and
+        self.node == other.node"""
+        return self.name == other.name and self.node == other.node
+
+    def __repr__(self):
+        return "<Ref %s %s>" % (self.name, self.node)
+
+
+class RefTransaction(object):
+    """A batch of ref updates applied atomically with a single
+    'git update-ref -z --stdin' call. Either all queued updates are
+    performed, or none of them are.
+
+    Old values, where given, are verified before anything is changed,
+    giving compare-and-swap semantics; pass None to skip the check.
+    Can be used as a context manager, committing on a clean exit::
+
+      with repo.ref_transaction() as refs:
+          refs.tag('v1.0', 'HEAD')
+          refs.branch('release', 'HEAD')
+    """
+    def __init__(self, repo):
+        self.repo = repo
+        self.commands = []
+
+    def __len__(self):
+        return len(self.commands)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+
+    def _queue(self, command, ref, *values):
+        """Queue command for ref in the NUL terminated -z format, where a
+        value of None is sent as an empty, i.e. missing, value"""
+        fields = [str(ref)] + ["" if value is None else str(value)
+                               for value in values]
+        for field in fields:
+            if "\0" in field or "\n" in field:
+                raise ValueError("Invalid ref or value %r" % field)
+        self.commands.append(command + " " + "\0".join(fields) + "\0")
+        return self
+
+    def create(self, ref, new):
+        """Create ref pointing to new; fails if ref already exists"""
+        return self._queue("create", ref, new)
+
+    def update(self, ref, new, old=None):
+        """Set ref to new, verifying it currently is old if given"""
+        return self._queue("update", ref, new, old)
+
+    def delete(self, ref, old=None):
+        """Delete ref, verifying it currently is old if given"""
+        return self._queue("delete", ref, old)
+
+    def verify(self, ref, old):
+        """Verify that ref currently is old without changing it"""
+        return self._queue("verify", ref, old)
+
+    def tag(self, name, reference="HEAD"):
+        """Create the lightweight tag named 'name'"""
+        return self.create("refs/tags/" + name, reference)
+
+    def branch(self, name, start="HEAD"):
+        """Create the branch named 'name'"""
+        return self.create("refs/heads/" + name, start)
+
+    def delete_tag(self, name, old=None):
+        """Delete the tag named 'name'"""
+        return self.delete("refs/tags/" + name, old)
+
+    def delete_branch(self, name, old=None):
+        """Delete the branch named 'name'"""
+        return self.delete("refs/heads/" + name, old)
+
+    def abort(self):
+        """Discard all queued updates"""
+        self.commands = []
+
+    def commit(self):
+        """Apply all queued updates. Throws on error, in which case no
+        ref has been changed."""
+        if not self.commands:
+            return
+        commands, self.commands = self.commands, []
+        self.repo.git_command("update-ref", "-z", "--stdin",
+                              input="".join(commands))
+
+
+class Conflict(object):
+    """A conflicted path in a MergeResult.
+    Available fields are::
+
+      path, base, ours, theirs, modes, types, messages
+
+    base, ours and theirs are the blob nodes of the path in each version,
+    or None where the path does not exist in that version, and modes maps
+    'base', 'ours' and 'theirs' to the file mode in each. types lists
+    the kinds of conflict reported by git for the path, e.g.
+    'CONFLICT (contents)', and messages the corresponding messages.
+    """
+    stages = {"1": "base", "2": "ours", "3": "theirs"}
+
+    def __init__(self, path):
+        self.path = path
+        self.base = self.ours = self.theirs = None
+        self.modes = {}
+        self.types = []
+        self.messages = []
+
+    def __repr__(self):
+        return "<Conflict %s>" % self.path
+
+
+class MergeResult(object):
+    """The result of an in-memory merge, as computed by Repo.merge_tree.
+    Available fields are::
+
+      tree, clean, conflicts, messages
+
+    tree is the node of the merged tree, with conflict markers in
+    conflicted files. conflicts is a list of Conflict objects, empty if
+    the merge is clean, and messages a list of (type, paths, message)
+    tuples with all informational messages from git.
+    """
+    def __init__(self, output):
+        """Create a MergeResult from 'git merge-tree --write-tree -z'
+        output"""
+        parts = output.split("\0")
+        self.tree = parts[0]
+        conflicts = {}
+        index = 1
+        while index < len(parts) and parts[index]:
+            info, ign, path = parts[index].partition("\t")
+            mode, node, stage = info.split()
+            conflict = conflicts.setdefault(path, Conflict(path))
+            setattr(conflict, Conflict.stages[stage], node)
+            conflict.modes[Conflict.stages[stage]] = mode
+            index += 1
+        index += 1
+        self.messages = []
+        while index < len(parts) - 1:
+            count = int(parts[index])
+            paths = parts[index + 1:index + 1 + count]
+            kind, message = parts[index + 1 + count:index + 3 + count]
+            self.messages.append((kind, paths, message.rstrip("\n")))
+            for path in paths:
+                if path in conflicts and kind.startswith("CONFLICT"):
+                    conflicts[path].types.append(kind)
+                    conflicts[path].messages.append(message.rstrip("\n"))
+            index += count + 3
+        self.conflicts = sorted(conflicts.values(),
+                                key=lambda conflict: conflict.path)
+        self.clean = not self.conflicts
+
+    def __repr__(self):
+        return "<MergeResult %s%s>" % (self.tree,
+                                       "" if self.clean else " conflicted")
+
+
+class Submodule(object):
+    """A submodule of a superproject.
+    Available fields are::
+
+      name, path, url, branch, node
+
+    path is relative to the superproject work tree, and node is the
+    commit recorded for the submodule in the superproject index. url and
+    branch come from .gitmodules and are None if not set there.
+    """
+    def __init__(self, superproject, name, path, url=None, branch=None,
+                 node=None):
+        self.superproject = superproject
+        self.name = name
+        self.path = path
+        self.url = url
+        self.branch = branch
+        self.node = node
+
+    @property
+    def repo(self):
+        """A Repo object for the submodule work tree"""
+        return Repo(os.path.join(self.superproject.work_tree, self.path),
+                    user=self.superproject.user)
+
+    @property
+    def initialized(self):
+        """True if the submodule has been cloned and checked out"""
+        return os.path.exists(os.path.join(self.superproject.work_tree,
+                                           self.path, ".git"))
+
+    def __repr__(self):
+        return "<Submodule %s %s>" % (self.path, self.node)
+
+
 class Repo(object):
     """A representation of a Mercurial repository"""
     def __init__(self, path, user=None):
@@ -53,34 +422,224 @@ class Repo(object):
         self.path = path
         self.cfg = False
         self.user = user
+        self._dirs = None
+
+    @classmethod
+    def open(cls, path, user=None):
+        """Create a Repo object from the repository at path, checking
+        that path is inside a repository. Throws if it is not."""
+        repo = cls(path, user=user)
+        repo.discover()
+        return repo
+
+    def discover(self):
+        """Locate the git directory of this repo without running git,
+        the same way git does: by looking for a .git directory or
+        .git file (worktrees, submodules, separate git dirs) in path and
+        its parents, or for path being a bare repository. GIT_DIR and
+        GIT_WORK_TREE in the environment are honoured.
+
+        Sets and returns (git_dir, common_dir, work_tree) - common_dir
+        differs from git_dir for linked worktrees, and work_tree is None
+        for bare repositories. Throws if no repository is found."""
+        start = os.path.abspath(self.path or ".")
+        if not os.path.isdir(start):
+            raise GitException("Not a directory: %s" % start)
+        if os.environ.get("GIT_DIR"):
+            git_dir = os.path.join(start, os.environ["GIT_DIR"])
+            work_tree = os.environ.get("GIT_WORK_TREE")
+            if work_tree:
+                work_tree = os.path.join(start, work_tree)
+            return self._found(git_dir, work_tree or start, start)
+        current = start
+        while True:
+            dotgit = os.path.join(current, ".git")
+            if os.path.isfile(dotgit):
+                with open(dotgit) as gitfile:
+                    match = _gitfile.match(gitfile.read())
+                if not match:
+                    raise GitException("Invalid gitfile format: %s" % dotgit)
+                return self._found(os.path.join(current, match.group(1)),
+                                   current, start)
+            if _is_git_dir(dotgit):
+                return self._found(dotgit, current, start)
+            if _is_git_dir(current):
+                return self._found(current, None, start)
+            parent = os.path.dirname(current)
+            if parent == current:
+                raise GitException("Not a git repository: %s" % start)
+            current = parent
+
+    def _found(self, git_dir, work_tree, start):
+        git_dir = os.path.normpath(git_dir)
+        if not _is_git_dir(git_dir):
+            raise GitException("Not a git repository: %s" % git_dir)
+        self._dirs = (git_dir, _common_dir(git_dir), work_tree)
+        return self._dirs
+
+    @property
+    def git_dir(self):
+        """The git directory of this repo, e.g. path/.git"""
+        return (self._dirs or self.discover())[0]
+
+    @property
+    def common_dir(self):
+        """The git directory holding objects and refs; differs from
+        git_dir only for linked worktrees"""
+        return (self._dirs or self.discover())[1]
+
+    @property
+    def work_tree(self):
+        """The top level of the working tree, or None for a bare repo"""
+        return (self._dirs or self.discover())[2]
+
+    @property
+    def bare(self):
+        """True if this is a bare repository"""
+        return self.work_tree is None
 
     def __getitem__(self, rev):
         """Get a Revision object for the revision identifed by rev"""
         return self.revision(rev)
 
     @classmethod
-    def command(cls, path, *args):
-        """Run a git command in path and return the result. Throws on error."""
+    def command(cls, path, *args, **kwargs):
+        """Run a git command in path and return the result. Throws on error.
+        If the keyword argument input is given, it is written to the
+        standard input of the git process. The keyword argument exit_codes
+        lists exit codes not considered errors (default only 0). If the
+        keyword argument stderr is true, (output, error output) is
+        returned instead."""
+        if not path:
+            path = '.'
+        stdin = kwargs.get('input')
+        proc = Popen(["git"] + list(args), stdout=PIPE, stderr=PIPE,
+                     stdin=PIPE if stdin is not None else None, cwd=path)
+
+        if stdin is not None:
+            stdin = stdin.encode("utf-8")
+        out, err = [x.decode("utf-8") for x in  proc.communicate(stdin)]
+
+        if proc.returncode not in kwargs.get('exit_codes', (0,)):
+            cls._raise_error(args, out, err, proc.returncode)
+        if kwargs.get('stderr'):
+            return out, err
+        return out
+
+    @classmethod
+    def command_lines(cls, path, *args):
+        """Run a git command in path and yield the output line by line
+        while it is running. Throws on error when the output is exhausted.
+        If the generator is closed early, the git process is killed."""
         if not path:
             path = '.'
         proc = Popen(["git"] + list(args), stdout=PIPE, stderr=PIPE, cwd=path)
+        try:
+            for line in proc.stdout:
+                yield line.decode("utf-8").rstrip("\r\n")
+        except GeneratorExit:
+            proc.kill()
+            proc.communicate()
+            raise
+        err = proc.stderr.read().decode("utf-8")
+        proc.stdout.close()
+        proc.stderr.close()
+        if proc.wait():
+            cls._raise_error(args, "", err, proc.returncode)
 
-        out, err = [x.decode("utf-8") for x in  proc.communicate()]
+    @classmethod
+    def command_chunks(cls, path, chunk_size, *args):
+        """Run a git command in path and yield the raw output in chunks of
+        at most chunk_size bytes while it is running. Throws on error when
+        the output is exhausted. If the generator is closed early, the git
+        process is killed."""
+        if not path:
+            path = '.'
+        proc = Popen(["git"] + list(args), stdout=PIPE, stderr=PIPE, cwd=path)
+        try:
+            while True:
+                chunk = proc.stdout.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        except GeneratorExit:
+            proc.kill()
+            proc.communicate()
+            raise
+        err = proc.stderr.read().decode("utf-8")
+        proc.stdout.close()
+        proc.stderr.close()
+        if proc.wait():
+            cls._raise_error(args, "", err, proc.returncode)
 
-        if proc.returncode:
-            cmd = "git " + " ".join(args)
-            raise GitException("Error running %s:\n\tErr: %s\n\tOut: %s\n\tExit: %s"
-                            % (cmd,err,out,proc.returncode), exit_code=proc.returncode)
+    @classmethod
+    def command_progress(cls, path, progress, *args):
+        """Run a git command in path and return the result, calling
+        progress with a Progress object for each progress line git writes
+        while running. Throws on error.
+        The command should include --progress, as git only reports
+        progress to a terminal by default."""
+        if not path:
+            path = '.'
+        proc = Popen(["git"] + list(args), stdout=PIPE, stderr=PIPE, cwd=path)
+        output = []
+        reader = threading.Thread(target=lambda:
+                                  output.append(proc.stdout.read()))
+        reader.daemon = True
+        reader.start()
+
+        err = []
+        def handle(line):
+            line = line.decode("utf-8")
+            event = Progress.parse(line)
+            if event is not None:
+                progress(event)
+            elif line.strip():
+                err.append(line.rstrip())
+        pending = b""
+        try:
+            while True:
+                chunk = os.read(proc.stderr.fileno(), 4096)
+                if not chunk:
+                    break
+                lines = re.split(b"[\r\n]", pending + chunk)
+                pending = lines.pop()
+                for line in lines:
+                    handle(line)
+            handle(pending)
+        except BaseException:
+            proc.kill()
+            reader.join()
+            proc.communicate()
+            raise
+        reader.join()
+        proc.stdout.close()
+        proc.stderr.close()
+        out = output[0].decode("utf-8") if output else ""
+        if proc.wait():
+            cls._raise_error(args, out, "\n".join(err), proc.returncode)
         return out
 
-    def git_command(self, *args):
+    @staticmethod
+    def _raise_error(args, out, err, exit_code):
+        cmd = "git " + " ".join(args)
+        raise GitException("Error running %s:\n\tErr: %s\n\tOut: %s\n\tExit: %s"
+                        % (cmd,err,out,exit_code), exit_code=exit_code)
+
+    def git_command(self, *args, **kwargs):
         """Run a git command on this repo and return the result.
         Throws on error."""
-        return Repo.command(self.path, *args)
+        return Repo.command(self.path, *args, **kwargs)
+
+    def git_command_lines(self, *args):
+        """Run a git command on this repo and yield the output
+        line by line. Throws on error."""
+        return Repo.command_lines(self.path, *args)
 
     def git_init(self):
         """Initialize a new repo"""
         self.git_command("init")
+        self._dirs = None
 
     def git_id(self):
         """Get the output of the git id command (truncated node)"""
@@ -131,10 +690,70 @@ class Repo(object):
 
         return self.git_command("tag", *args)
 
+    ref_fields = ("name", "node", "peeled", "date", "peeled_date", "desc")
+    ref_format = "%00".join(("%(refname)", "%(objectname)", "%(*objectname)",
+                             "%(committerdate:iso)", "%(*committerdate:iso)",
+                             "%(contents:subject)"))
+
+    def refs(self, pattern=None, sort=None, limit=None, offset=0):
+        """Iterate over refs as Ref objects, using a single
+        'git for-each-ref' call. The output is parsed while git is running.
+
+        pattern is a for-each-ref pattern or list of patterns
+        (e.g. 'refs/tags'), sort a for-each-ref sort key or list of keys
+        (e.g. '-committerdate'). limit and offset select a page of the
+        sorted result, and must not be negative."""
+        if (limit is not None and limit < 0) or offset < 0:
+            raise ValueError("limit and offset must not be negative")
+        if limit == 0:
+            return iter([])
+        return self._refs(pattern, sort, limit, offset)
+
+    def _refs(self, pattern, sort, limit, offset):
+        args = ["for-each-ref", "--format=" + self.ref_format]
+        if sort and not isinstance(sort, (list, tuple)):
+            sort = [sort]
+        for key in sort or []:
+            args.append("--sort=" + key)
+        if limit is not None:
+            args.append("--count=%d" % (offset + limit))
+        if pattern and not isinstance(pattern, (list, tuple)):
+            pattern = [pattern]
+        args.extend(pattern or [])
+        for i, line in enumerate(self.git_command_lines(*args)):
+            if i >= offset:
+                yield Ref(dict(zip(self.ref_fields, line.split("\0"))))
+
+    def ref_transaction(self):
+        """Get a RefTransaction for batched, atomic ref updates"""
+        return RefTransaction(self)
+
     def git_merge(self, reference):
         """Merge reference to current"""
         self.git_command("merge", reference)
 
+    def merge_tree(self, base, ours, theirs):
+        """Merge theirs into ours without touching the index or working
+        tree, using 'git merge-tree --write-tree', and return a
+        MergeResult. base is the merge base to use, or None to let git
+        find it; an explicit base requires git 2.40 or later.
+        Only objects are written, so merges can run in parallel."""
+        args = ["merge-tree", "--write-tree", "-z"]
+        if base is not None:
+            args.append("--merge-base=" + base)
+        args += [ours, theirs]
+        out, err = self.git_command(*args, exit_codes=(0, 1), stderr=True)
+        if not out:
+            # git exits with 1 both on conflicts and on bad arguments
+            Repo._raise_error(args, out, err, 1)
+        return MergeResult(out)
+
+    def merge_trees(self, merges, jobs=8):
+        """Run merge_tree for each (base, ours, theirs) tuple in merges
+        using up to jobs parallel git processes, and return the list of
+        MergeResults in the same order"""
+        return _parallel(lambda merge: self.merge_tree(*merge), merges, jobs)
+
     def git_reset(self, hard=True, *files):
         """Revert repository"""
 
@@ -188,33 +807,212 @@ class Repo(object):
             if not out:
                 return changes
         lines = out.split("\n")
-        status_split = re.compile("^([^\s]+)\s+(.*)$")
 
-        for change, path in [status_split.match(x.strip()).groups() for x in lines]:
+        for change, path in [_status_split.match(x.strip()).groups() for x in lines]:
             changes.setdefault(change, []).append(path)
         return changes
 
-    def git_push(self, destination=None, branch=None):
-        """Push changes from this repo."""
+    def _transfer(self, cmd, args, progress):
+        """Run a push, pull or fetch command, reporting progress to the
+        progress callable if given"""
+        if progress is None:
+            return self.git_command(cmd, *args)
+        return Repo.command_progress(self.path, progress,
+                                     cmd, "--progress", *args)
+
+    @staticmethod
+    def _check_refspecs(remote, refspecs):
+        """Refspecs are only meaningful after a remote; without one git
+        would take the first refspec as the remote"""
+        if refspecs and not remote:
+            raise ValueError("refspecs given without a remote")
+
+    @staticmethod
+    def _transfer_args(prune=False, depth=None, filter=None, jobs=None):
+        args = []
+        if prune:
+            args.append("--prune")
+        if depth is not None:
+            args.append("--depth=%d" % depth)
+        if filter is not None:
+            args.append("--filter=" + filter)
+        if jobs is not None:
+            args.append("--jobs=%d" % jobs)
+        return args
+
+    def git_push(self, destination=None, branch=None, refspecs=(),
+                 progress=None):
+        """Push changes from this repo.
+        refspecs are pushed in addition to branch. If progress is given,
+        it is called with a Progress object for each progress update.
+        Throws ValueError if refspecs are given without a destination."""
+        self._check_refspecs(destination, refspecs)
         args = [arg for arg in (destination, branch)
                 if arg is not None]
-        self.git_command("push", *args)
+        self._transfer("push", args + list(refspecs), progress)
 
-    def git_pull(self, source=None, rebase=False):
-        """Pull changes to this repo."""
+    def git_pull(self, source=None, rebase=False, refspecs=(), prune=False,
+                 depth=None, jobs=None, progress=None):
+        """Pull changes to this repo.
+        See git_fetch for the meaning of the arguments."""
+        self._check_refspecs(source, refspecs)
         args = []
         if rebase:
             args.append('--rebase')
+        args.extend(self._transfer_args(prune=prune, depth=depth, jobs=jobs))
         if source:
             args.append(source)
-        self.git_command("pull", *args)
+        self._transfer("pull", args + list(refspecs), progress)
 
-    def git_fetch(self, source=None):
-        """Fetch changes to this repo."""
-        if source is None:
-            self.git_command("fetch")
-        else:
-            self.git_command("fetch", source)
+    def git_fetch(self, source=None, refspecs=(), prune=False, depth=None,
+                  filter=None, jobs=None, multiple=False, progress=None,
+                  recurse_submodules=None):
+        """Fetch changes to this repo.
+        refspecs select what to fetch from source. prune removes
+        remote-tracking refs no longer on the remote, depth makes a shallow
+        fetch and filter a partial one (e.g. 'blob:none'). If multiple is
+        set, source is a list of remotes fetched in parallel by up to jobs
+        processes; jobs also sets the number of parallel submodule fetches.
+        recurse_submodules is passed as --recurse-submodules ('yes', 'no'
+        or 'on-demand'; git's default is 'on-demand'). If progress is given, it is called with a Progress object for
+        each progress update. Returns the output of git fetch.
+        Throws ValueError if refspecs are given without a single source."""
+        self._check_refspecs(None if multiple else source, refspecs)
+        args = self._transfer_args(prune=prune, depth=depth, filter=filter,
+                                   jobs=jobs)
+        if recurse_submodules is not None:
+            args.append("--recurse-submodules=" + recurse_submodules)
+        if multiple:
+            args.append("--multiple")
+            args.extend(source or [])
+        elif source is not None:
+            args.append(source)
+        return self._transfer("fetch", args + list(refspecs), progress)
+
+    def archive(self, rev="HEAD", paths=(), format="tar", output=None,
+                prefix=None, compression_level=None, chunk_size=65536):
+        """Export the tree of rev as an archive using 'git archive',
+        without touching the index or working tree.
+
+        format is one of tar, zip, tar.gz or tgz, and paths limits the
+        archive to the given paths. prefix is prepended to every file
+        name, e.g. 'project/'. compression_level (0-9) applies to zip and
+        gzipped tar formats.
+
+        If output is a file-like object, the archive is written to it;
+        otherwise an iterator over chunks of at most chunk_size bytes is
+        returned. Throws on error."""
+        args = ["archive", "--format=" + format]
+        if prefix is not None:
+            args.append("--prefix=" + prefix)
+        if compression_level is not None:
+            args.append("-%d" % compression_level)
+        args.append(rev)
+        if paths:
+            args.append("--")
+            args.extend(paths)
+        chunks = Repo.command_chunks(self.path, chunk_size, *args)
+        if output is None:
+            return chunks
+        for chunk in chunks:
+            output.write(chunk)
+
+    def submodules(self, recursive=False):
+        """Get the submodules of this repo as a list of Submodule objects,
+        from the gitlinks in the index and their .gitmodules entries.
+        If recursive is set, submodules of initialized submodules are
+        included, with paths relative to this repo. A bare repo has no
+        submodules."""
+        if self.bare:
+            return []
+        modules = {}
+        gitmodules = os.path.join(self.work_tree, ".gitmodules")
+        if os.path.isfile(gitmodules):
+            # exits with 1 if there are no submodule entries
+            res = self.git_command("config", "-f", gitmodules, "-z",
+                                   "--get-regexp", r"^submodule\.",
+                                   exit_codes=(0, 1))
+            for entry in res.split("\0"):
+                key, ign, value = entry.partition("\n")
+                name, ign, var = key[len("submodule."):].rpartition(".")
+                if name:
+                    modules.setdefault(name, {})[var] = value
+        by_path = dict((module.get("path"), (name, module))
+                       for name, module in modules.items())
+        submodules = []
+        index = Repo.command(self.work_tree, "ls-files", "-s", "-z")
+        for entry in index.split("\0"):
+            info, ign, path = entry.partition("\t")
+            if not info.startswith("160000 "):
+                continue
+            name, module = by_path.get(path, (path, {}))
+            submodules.append(Submodule(self, name, path,
+                                        url=module.get("url"),
+                                        branch=module.get("branch"),
+                                        node=info.split()[1]))
+        if recursive:
+            for submodule in list(submodules):
+                if not submodule.initialized:
+                    continue
+                for nested in submodule.repo.submodules(recursive=True):
+                    nested.superproject = self
+                    nested.path = submodule.path + "/" + nested.path
+                    submodules.append(nested)
+        return submodules
+
+    def _recursive(self, func, jobs):
+        """Call func on this repo and every initialized submodule,
+        recursively, using up to jobs threads. Returns a dict mapping
+        submodule path, or '' for this repo, to the result. If any call
+        fails, the others still run and a SubmoduleError is raised."""
+        repos = [("", self)] + [(submodule.path, submodule.repo)
+                                for submodule in self.submodules(True)
+                                if submodule.initialized]
+        def call(repo):
+            try:
+                return func(repo), None
+            except (GitException, EnvironmentError) as exc:
+                return None, exc
+        outcomes = _parallel(lambda item: call(item[1]), repos, jobs)
+        results, errors = {}, {}
+        for (path, repo), (result, error) in zip(repos, outcomes):
+            if error is None:
+                results[path] = result
+            else:
+                errors[path] = error
+        if errors:
+            raise SubmoduleError(results, errors)
+        return results
+
+    def status_recursive(self, jobs=8):
+        """Get git_status for this repo and all initialized submodules,
+        as a dict mapping submodule path, or '' for this repo, to the
+        status. Submodules are queried by up to jobs parallel processes.
+        Throws SubmoduleError if any of them fails."""
+        return self._recursive(lambda repo: repo.git_status(), jobs)
+
+    def fetch_recursive(self, jobs=8, **kwargs):
+        """Run git_fetch with the given keyword arguments in this repo and
+        all initialized submodules, using up to jobs parallel processes.
+        Returns a dict mapping submodule path, or '' for this repo, to the
+        git_fetch result. Throws SubmoduleError if any fetch fails, after
+        all fetches have run. Each fetch runs with --recurse-submodules=no,
+        so no submodule is fetched twice."""
+        kwargs["recurse_submodules"] = "no"
+        return self._recursive(lambda repo: repo.git_fetch(**kwargs), jobs)
+
+    def update_submodules(self, init=True, recursive=True, jobs=8):
+        """Check out the commits recorded in the index in all submodules,
+        cloning up to jobs submodules in parallel. If init is set,
+        uninitialized submodules are initialized first. Returns the
+        updated list of submodules."""
+        args = ["submodule", "update", "--jobs=%d" % jobs]
+        if init:
+            args.append("--init")
+        if recursive:
+            args.append("--recursive")
+        self.git_command(*args)
+        return self.submodules(recursive=recursive)
 
     @classmethod
     def git_clone(cls, url, path, *args):
@@ -223,6 +1021,97 @@ class Repo(object):
         Repo.command(None, "clone", url, path, *args)
         return Repo(path)
 
+    def git_gc(self, aggressive=False, auto=False, prune=None):
+        """Run garbage collection, packing all objects into one pack"""
+        args = ["gc", "--quiet"]
+        if aggressive:
+            args.append("--aggressive")
+        if auto:
+            args.append("--auto")
+        if prune is not None:
+            args.append("--prune=" + prune)
+        self.git_command(*args)
+
+    def git_repack(self, all=False, delete=True, local=True):
+        """Pack loose objects. If all is set, pack everything into a
+        single pack instead of only adding a pack for loose objects"""
+        args = ["repack", "-q"]
+        if all:
+            args.append("-a")
+        if delete:
+            args.append("-d")
+        if local:
+            args.append("-l")
+        self.git_command(*args)
+
+    def git_prune(self, expire=None):
+        """Remove unreachable loose objects, only those older than expire
+        (e.g. '2.weeks.ago') if given"""
+        args = ["prune"]
+        if expire is not None:
+            args.append("--expire=" + expire)
+        self.git_command(*args)
+
+    def git_commit_graph(self, split=True):
+        """Write a commit-graph file for all reachable commits. If split
+        is set, only commits missing from existing graphs are written"""
+        args = ["commit-graph", "write", "--reachable"]
+        if split:
+            args.append("--split")
+        self.git_command(*args)
+
+    def git_multi_pack_index(self, repack_batch_size=None):
+        """Write a multi-pack-index covering all packs. If
+        repack_batch_size is given, also combine packs smaller than that
+        many bytes into a new pack, and drop the packs no longer needed"""
+        self.git_command("multi-pack-index", "write")
+        if repack_batch_size is not None:
+            self.git_command("multi-pack-index", "repack",
+                             "--batch-size=%d" % repack_batch_size)
+            self.git_command("multi-pack-index", "expire")
+
+    def objects_path(self):
+        """Get the path to the object directory of this repo"""
+        return os.path.join(self.common_dir, "objects")
+
+    def health(self):
+        """Get object storage metrics for this repo as a dict with the keys::
+
+          loose_objects, loose_size, packs, pack_size, garbage,
+          commit_graph, commit_graph_stale, multi_pack_index
+
+        Sizes are in KiB; commit_graph and multi_pack_index are true if
+        the corresponding file is present. commit_graph_stale is true if
+        a pack has been written after the commit-graph."""
+        stats = {}
+        for row in self.git_command("count-objects", "-v").split("\n"):
+            key, ign, value = row.partition(":")
+            if value:
+                stats[key.strip()] = int(value)
+        objects = self.objects_path()
+        info = os.path.join(objects, "info")
+        pack_dir = os.path.join(objects, "pack")
+        graphs = [_mtime(os.path.join(info, "commit-graph")),
+                  _mtime(os.path.join(info, "commit-graphs",
+                                      "commit-graph-chain"))]
+        graph = max([mtime for mtime in graphs if mtime is not None] or [None])
+        packs = []
+        if os.path.isdir(pack_dir):
+            packs = [_mtime(os.path.join(pack_dir, name))
+                     for name in os.listdir(pack_dir)
+                     if name.endswith(".pack")]
+        packs = [mtime for mtime in packs if mtime is not None]
+        return {"loose_objects": stats.get("count", 0),
+                "loose_size": stats.get("size", 0),
+                "packs": stats.get("packs", 0),
+                "pack_size": stats.get("size-pack", 0),
+                "garbage": stats.get("garbage", 0),
+                "commit_graph": graph is not None,
+                "commit_graph_stale": (graph is not None and bool(packs)
+                                       and max(packs) > graph),
+                "multi_pack_index": os.path.exists(
+                    os.path.join(pack_dir, "multi-pack-index"))}
+
     rev_log_tpl = '--pretty=format:{"node":"%h","author":"%an", "parents":"%p","date":"%ci","desc":"%s"}'
 
     def revision(self, identifier):
@@ -279,3 +1168,118 @@ class Repo(object):
             return value.split(",")
         else:
             return value.split()
+
+
+class MaintenanceScheduler(object):
+    """Runs maintenance tasks across many repositories within a time budget.
+
+    Each call to run() collects health metrics for every repo, decides
+    which tasks are due, and runs them most degraded repo first until
+    budget seconds have passed. The health scan does not count against
+    the budget. Tasks not reached are picked up by the next run.
+    Available tasks, cheapest first, are::
+
+      commit-graph      when no commit-graph is present, or a pack was
+                        written after it
+      multi-pack-index  when there are several packs but no multi-pack-index
+      repack            when there are more than loose_limit loose objects
+                        beyond those left by the last repack, prune or gc
+      prune             when a repack left more than loose_limit loose
+                        objects, which are then unreachable; only objects
+                        older than prune_expire are removed
+      gc                when there are more than pack_limit packs
+
+    The number of loose objects left after repack, prune and gc is kept
+    in self.unpackable, keyed on repo path, so that unreachable objects
+    that cannot be removed yet do not trigger the same task every run.
+
+    The health metrics from the last run are kept in self.health,
+    keyed on repo path. Errors do not stop the run: they are kept in
+    self.failures, mapping repo path to a (task, exception) pair, where
+    task is None if the health scan failed. Once a task fails, the other
+    tasks for that repo wait for the next run, where the failed task is
+    run after all others.
+    """
+    tasks = ("commit-graph", "multi-pack-index", "repack", "prune", "gc")
+
+    def __init__(self, repos, budget=None, loose_limit=1000, pack_limit=50,
+                 prune_expire="2.weeks.ago"):
+        self.repos = list(repos)
+        self.budget = budget
+        self.loose_limit = loose_limit
+        self.pack_limit = pack_limit
+        self.prune_expire = prune_expire
+        self.health = {}
+        self.failures = {}
+        self.unpackable = {}
+
+    def due(self, health, path=None):
+        """Get a list of (priority, task) pairs due for the given health
+        metrics of the repo at path; a higher priority means the repo is
+        more degraded"""
+        due = []
+        left, pruned = self.unpackable.get(path, (0, True))
+        loose = health["loose_objects"] - left
+        if health["packs"] > self.pack_limit:
+            due.append((float(health["packs"]) / self.pack_limit, "gc"))
+        elif loose > self.loose_limit:
+            due.append((float(loose) / self.loose_limit, "repack"))
+        elif health["loose_objects"] > self.loose_limit and not pruned:
+            due.append((1.0, "prune"))
+        elif health["packs"] > 1 and not health["multi_pack_index"]:
+            due.append((1.0, "multi-pack-index"))
+        if not health["commit_graph"] or health["commit_graph_stale"]:
+            due.append((1.0, "commit-graph"))
+        return due
+
+    def run_task(self, repo, task):
+        """Run a single maintenance task on repo"""
+        if task == "gc":
+            repo.git_gc()
+        elif task == "repack":
+            repo.git_repack()
+        elif task == "prune":
+            repo.git_prune(expire=self.prune_expire)
+        elif task == "multi-pack-index":
+            repo.git_multi_pack_index()
+        elif task == "commit-graph":
+            repo.git_commit_graph()
+        else:
+            raise ValueError("Unknown maintenance task %s" % task)
+
+    def run(self):
+        """Run due tasks until the budget is spent. Returns a list of
+        (repo, task) pairs for the tasks that were run"""
+        failed, self.failures = self.failures, {}
+        pending = []
+        for index, repo in enumerate(self.repos):
+            try:
+                health = repo.health()
+            except (GitException, EnvironmentError) as exc:
+                self.health.pop(repo.path, None)
+                self.failures[repo.path] = (None, exc)
+                continue
+            self.health[repo.path] = health
+            for priority, task in self.due(health, repo.path):
+                retry = failed.get(repo.path, (None,))[0] == task
+                pending.append((retry, -priority, index,
+                                self.tasks.index(task), task))
+        pending.sort()
+        start = time.time()
+        done = []
+        for ign, ign, index, ign, task in pending:
+            if self.budget is not None and time.time() - start >= self.budget:
+                break
+            repo = self.repos[index]
+            if repo.path in self.failures:
+                continue
+            try:
+                self.run_task(repo, task)
+                if task in ("repack", "prune", "gc"):
+                    self.unpackable[repo.path] = (
+                        repo.health()["loose_objects"], task != "repack")
+            except (GitException, EnvironmentError) as exc:
+                self.failures[repo.path] = (task, exc)
+                continue
+            done.append((repo, task))
+        return done
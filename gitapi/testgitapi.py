@@ -222,6 +222,611 @@ class TestGitAPI(unittest.TestCase):
         self.repo.git_tag('testtag', 'message', annotated=True)
         self.assertEquals(self.repo.git_tags(), ['testtag'])
 
+
+class RepoTestCase(unittest.TestCase):
+    """Base class for tests needing a fresh repository with two commits,
+    created in the subfolder named by 'path' and wiped afterwards"""
+    path = None
+
+    @classmethod
+    def setUpClass(cls):
+        TestGitAPI._delete_and_create(cls.path)
+        cls.repo = gitapi.Repo(cls.path)
+        cls.repo.git_init()
+        cls.repo.git_command("config", "user.name", "Testuser")
+        cls.repo.git_command("config", "user.email", "test@example.com")
+        for content in ("stuff", "more stuff"):
+            with open(os.path.join(cls.path, "file.txt"), "w") as out:
+                out.write(content)
+            cls.repo.git_add("file.txt")
+            cls.repo.git_command("commit", "-m", content)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.path, ignore_errors=True)
+
+
+class TestRefTransaction(RepoTestCase):
+    path = "./test-refs"
+
+    def test_010_create(self):
+        with self.repo.ref_transaction() as refs:
+            for i in range(20):
+                refs.tag("v%d" % i, "HEAD~1")
+            refs.branch("release")
+        self.assertEqual(len(self.repo.git_tags()), 20)
+        self.assertTrue("release" in self.repo.git_branches())
+
+    def test_020_atomic(self):
+        refs = self.repo.ref_transaction()
+        refs.tag("new-tag").tag("v0")
+        self.assertRaises(gitapi.GitException, refs.commit)
+        self.assertFalse("new-tag" in self.repo.git_tags())
+
+    def test_030_compare_and_swap(self):
+        head = self.repo.git_id()
+        parent = self.repo.git_command("rev-parse", "HEAD~1").strip()
+        refs = self.repo.ref_transaction()
+        refs.update("refs/heads/release", parent, old=parent)
+        self.assertRaises(gitapi.GitException, refs.commit)
+        refs.update("refs/heads/release", parent, old=head).commit()
+        self.assertEqual(self.repo.git_command(
+            "rev-parse", "release").strip(), parent)
+
+    def test_040_delete(self):
+        with self.repo.ref_transaction() as refs:
+            for i in range(20):
+                refs.delete_tag("v%d" % i)
+            refs.delete_branch("release")
+        self.assertEqual(self.repo.git_tags(), [])
+        self.assertFalse("release" in self.repo.git_branches())
+
+    def test_045_crafted_names(self):
+        self.repo.git_branch("victim")
+        refs = self.repo.ref_transaction()
+        self.assertRaises(ValueError, refs.tag,
+                          "x HEAD\ndelete refs/heads/victim")
+        self.assertRaises(ValueError, refs.tag, "x\0delete refs/heads/victim")
+        refs.tag("x HEAD delete refs/heads/victim")
+        self.assertRaises(gitapi.GitException, refs.commit)
+        self.assertTrue("victim" in self.repo.git_branches())
+        self.assertEqual(self.repo.git_tags(), [])
+        self.repo.git_command("branch", "-D", "victim")
+
+    def test_050_abort_on_error(self):
+        try:
+            with self.repo.ref_transaction() as refs:
+                refs.tag("never")
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(self.repo.git_tags(), [])
+
+
+class TestRefs(RepoTestCase):
+    path = "./test-listrefs"
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestRefs, cls).setUpClass()
+        with cls.repo.ref_transaction() as refs:
+            for i in range(10):
+                refs.tag("t%d" % i, "HEAD~1")
+        cls.repo.git_tag("annotated", "tag message", annotated=True)
+
+    def test_010_fields(self):
+        refs = dict((ref.short_name, ref) for ref in self.repo.refs())
+        head = self.repo.git_id()
+        self.assertEqual(refs["master"].name, "refs/heads/master")
+        self.assertEqual(refs["master"].node, head)
+        self.assertEqual(refs["master"].peeled, head)
+        self.assertEqual(refs["master"].desc, "more stuff")
+        self.assertEqual(refs["master"].date,
+                         self.repo["HEAD"].date)
+        self.assertNotEqual(refs["annotated"].node, head)
+        self.assertEqual(refs["annotated"].peeled, head)
+        self.assertEqual(refs["annotated"].desc, "tag message")
+        self.assertEqual(refs["annotated"].date, refs["master"].date)
+        self.assertEqual(refs["t0"].desc, "stuff")
+
+    def test_020_pattern(self):
+        names = [ref.short_name for ref in self.repo.refs("refs/heads")]
+        self.assertEqual(names, ["master"])
+        names = [ref.name for ref in self.repo.refs(["refs/tags/t1",
+                                                     "refs/heads"])]
+        self.assertEqual(names, ["refs/heads/master", "refs/tags/t1"])
+
+    def test_030_paginate(self):
+        tags = [ref.short_name for ref in
+                self.repo.refs("refs/tags/t*", sort="-refname")]
+        self.assertEqual(tags, ["t%d" % i for i in range(9, -1, -1)])
+        page = [ref.short_name for ref in
+                self.repo.refs("refs/tags/t*", sort="-refname",
+                               limit=3, offset=3)]
+        self.assertEqual(page, tags[3:6])
+        self.assertEqual(list(self.repo.refs("refs/tags", offset=20)), [])
+        self.assertEqual(list(self.repo.refs(limit=0)), [])
+        self.assertRaises(ValueError, self.repo.refs, limit=-1)
+        self.assertRaises(ValueError, self.repo.refs, offset=-1)
+
+    def test_040_stream(self):
+        refs = self.repo.refs()
+        self.assertEqual(next(refs).name, "refs/heads/master")
+        refs.close()
+
+
+class TestMaintenance(RepoTestCase):
+    path = "./test-maintenance"
+
+    def test_010_health(self):
+        health = self.repo.health()
+        self.assertEqual(health["loose_objects"], 6)
+        self.assertEqual(health["packs"], 0)
+        self.assertFalse(health["commit_graph"])
+        self.assertFalse(health["multi_pack_index"])
+
+    def test_020_budget(self):
+        scheduler = gitapi.MaintenanceScheduler([self.repo], budget=0)
+        self.assertEqual(scheduler.run(), [])
+        self.assertEqual(scheduler.health[self.repo.path]["loose_objects"], 6)
+
+    def test_030_run(self):
+        scheduler = gitapi.MaintenanceScheduler([self.repo], loose_limit=5)
+        self.assertEqual([task for repo, task in scheduler.run()],
+                         ["repack", "commit-graph"])
+        health = self.repo.health()
+        self.assertEqual(health["loose_objects"], 0)
+        self.assertEqual(health["packs"], 1)
+        self.assertTrue(health["commit_graph"])
+        self.assertEqual(scheduler.run(), [])
+
+    def test_040_multi_pack_index(self):
+        with open(os.path.join(self.path, "file.txt"), "w") as out:
+            out.write("even more stuff")
+        self.repo.git_add("file.txt")
+        self.repo.git_command("commit", "-m", "even more stuff")
+        self.repo.git_repack()
+        self.assertTrue(self.repo.health()["commit_graph_stale"])
+        scheduler = gitapi.MaintenanceScheduler([self.repo], pack_limit=1)
+        self.assertEqual([task for repo, task in scheduler.run()],
+                         ["gc", "commit-graph"])
+        self.assertFalse(self.repo.health()["commit_graph_stale"])
+        self.assertEqual(self.repo.health()["packs"], 1)
+        self.repo.git_multi_pack_index()
+        self.assertTrue(self.repo.health()["multi_pack_index"])
+
+    def test_045_unreachable(self):
+        for i in range(30):
+            self.repo.git_command("hash-object", "-w", "--stdin",
+                                  input="unreachable %d" % i)
+        scheduler = gitapi.MaintenanceScheduler([self.repo], loose_limit=10)
+        self.assertEqual([task for repo, task in scheduler.run()],
+                         ["repack"])
+        self.assertEqual([task for repo, task in scheduler.run()],
+                         ["prune"])
+        self.assertEqual(self.repo.health()["loose_objects"], 30)
+        self.assertEqual(scheduler.run(), [])
+        scheduler.prune_expire = "now"
+        scheduler.unpackable[self.repo.path] = (30, False)
+        self.assertEqual([task for repo, task in scheduler.run()],
+                         ["prune"])
+        self.assertEqual(self.repo.health()["loose_objects"], 0)
+
+    def test_050_failures(self):
+        class Failing(gitapi.MaintenanceScheduler):
+            def run_task(self, repo, task):
+                if repo.path == "./test-maintenance-failing":
+                    raise gitapi.GitException("task failed", exit_code=1)
+                super(Failing, self).run_task(repo, task)
+        missing = gitapi.Repo("./test-maintenance-missing")
+        failing = gitapi.Repo("./test-maintenance-failing")
+        TestGitAPI._delete_and_create(failing.path)
+        try:
+            failing.git_init()
+            scheduler = Failing([missing, failing, self.repo])
+            info = os.path.join(self.path, ".git", "objects", "info")
+            shutil.rmtree(os.path.join(info, "commit-graphs"),
+                          ignore_errors=True)
+            if os.path.exists(os.path.join(info, "commit-graph")):
+                os.remove(os.path.join(info, "commit-graph"))
+            self.assertEqual(scheduler.run(), [(self.repo, "commit-graph")])
+            self.assertEqual(scheduler.failures[missing.path][0], None)
+            self.assertEqual(scheduler.failures[failing.path][0],
+                             "commit-graph")
+            self.assertFalse(self.repo.path in scheduler.failures)
+            self.assertFalse(missing.path in scheduler.health)
+        finally:
+            shutil.rmtree(failing.path)
+
+
+class TestTransfer(RepoTestCase):
+    path = "./test-transfer"
+    clone = gitapi.Repo("./test-transfer-clone")
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestTransfer, cls).setUpClass()
+        cls.url = "file://" + os.path.abspath(cls.path)
+        cls.repo.git_command("config", "uploadpack.allowFilter", "true")
+        TestGitAPI._delete_and_create(cls.clone.path)
+        cls.clone.git_init()
+        cls.clone.git_command("remote", "add", "origin", cls.url)
+        cls.clone.git_command("remote", "add", "other", cls.url)
+
+    @classmethod
+    def tearDownClass(cls):
+        super(TestTransfer, cls).tearDownClass()
+        shutil.rmtree(cls.clone.path, ignore_errors=True)
+
+    def test_010_progress_parse(self):
+        event = gitapi.Progress.parse(
+            "Receiving objects: 100% (9/9), 1.50 MiB | 512.00 KiB/s, done.")
+        self.assertEqual(event.phase, "Receiving objects")
+        self.assertEqual((event.percent, event.current, event.total),
+                         (100, 9, 9))
+        self.assertEqual(event.bytes, 1572864)
+        self.assertEqual(event.throughput, 524288)
+        self.assertTrue(event.done)
+        event = gitapi.Progress.parse("remote: Enumerating objects: 5, done.")
+        self.assertTrue(event.remote)
+        self.assertEqual((event.current, event.total), (5, None))
+        self.assertEqual(gitapi.Progress.parse("From /some/where"), None)
+
+    def test_020_shallow_fetch(self):
+        events = []
+        self.clone.git_fetch("origin",
+                             refspecs=["master:refs/remotes/origin/master"],
+                             depth=1, filter="blob:none",
+                             progress=events.append)
+        phases = set(event.phase for event in events)
+        self.assertTrue("Receiving objects" in phases)
+        self.assertTrue(any(event.done for event in events))
+        log = self.clone.git_command("log", "--oneline", "origin/master")
+        self.assertEqual(len(log.strip().split("\n")), 1)
+
+    def test_030_fetch_multiple(self):
+        self.clone.git_fetch(["origin", "other"], multiple=True, jobs=2)
+        self.assertEqual(self.clone.git_command(
+            "rev-parse", "other/master").strip(), self.repo.git_id())
+
+    def test_040_prune(self):
+        self.repo.git_branch("gone")
+        self.clone.git_fetch("origin")
+        self.assertTrue("origin/gone" in self.clone.git_command("branch", "-r"))
+        self.repo.git_command("branch", "-D", "gone")
+        self.clone.git_fetch("origin", prune=True)
+        self.assertFalse("origin/gone" in self.clone.git_command("branch", "-r"))
+
+    def test_050_pull_push(self):
+        events = []
+        self.clone.git_pull("origin", refspecs=["master"],
+                            progress=events.append)
+        self.assertEqual(self.clone.git_id(), self.repo.git_id())
+        self.clone.git_push("origin", refspecs=["HEAD:refs/heads/pushed"],
+                            progress=events.append)
+        self.assertTrue("pushed" in self.repo.git_branches())
+        self.assertRaises(gitapi.GitException, self.clone.git_fetch,
+                          "origin", refspecs=["missing"],
+                          progress=events.append)
+
+    def test_060_refspecs_without_remote(self):
+        self.assertRaises(ValueError, self.clone.git_pull,
+                          refspecs=["master"])
+        self.assertRaises(ValueError, self.clone.git_push,
+                          refspecs=["master"])
+        self.assertRaises(ValueError, self.clone.git_fetch,
+                          refspecs=["master"])
+        self.assertRaises(ValueError, self.clone.git_fetch, ["origin"],
+                          refspecs=["master"], multiple=True)
+
+    def test_070_failing_progress_callback(self):
+        def progress(event):
+            raise KeyError(event.phase)
+        with open(os.path.join(self.path, "file.txt"), "w") as out:
+            out.write("callback stuff")
+        self.repo.git_command("commit", "-am", "callback")
+        self.assertRaises(KeyError, self.clone.git_fetch, "origin",
+                          refspecs=["master:refs/heads/callback"],
+                          progress=progress)
+
+
+class TestArchive(RepoTestCase):
+    path = "./test-archive"
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestArchive, cls).setUpClass()
+        os.mkdir(os.path.join(cls.path, "sub"))
+        with open(os.path.join(cls.path, "sub", "other.txt"), "w") as out:
+            out.write("other stuff")
+        cls.repo.git_add("sub")
+        cls.repo.git_command("commit", "-m", "adding sub")
+
+    def test_010_tar(self):
+        import io, tarfile
+        output = io.BytesIO()
+        self.repo.archive("HEAD~1", output=output, prefix="project/")
+        output.seek(0)
+        archive = tarfile.open(fileobj=output)
+        self.assertEqual(archive.getnames(), ["project", "project/file.txt"])
+        self.assertEqual(archive.extractfile("project/file.txt").read(),
+                         b"more stuff")
+
+    def test_020_zip_chunks(self):
+        import io, zipfile
+        chunks = list(self.repo.archive(paths=["sub"], format="zip",
+                                        compression_level=9, chunk_size=64))
+        self.assertTrue(len(chunks) > 1)
+        self.assertTrue(max(len(chunk) for chunk in chunks) <= 64)
+        archive = zipfile.ZipFile(io.BytesIO(b"".join(chunks)))
+        self.assertEqual(archive.namelist(), ["sub/", "sub/other.txt"])
+
+    def test_030_worktree_untouched(self):
+        with open(os.path.join(self.path, "file.txt"), "w") as out:
+            out.write("local change")
+        list(self.repo.archive("HEAD~1"))
+        self.assertEqual(self.repo.git_status(), {'M': ['file.txt']})
+        self.assertRaises(gitapi.GitException, list,
+                          self.repo.archive("missing"))
+
+
+class TestOpen(RepoTestCase):
+    path = "./test-open"
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestOpen, cls).setUpClass()
+        cls.top = os.path.abspath(cls.path)
+        os.mkdir(os.path.join(cls.path, "sub"))
+        cls.repo.git_command("worktree", "add", "-q", "wt", "-b", "wt")
+        gitapi.Repo.git_clone(cls.path, os.path.join(cls.path, "bare.git"),
+                              "--bare")
+        gitapi.Repo.command(cls.path, "init", "-q", "--separate-git-dir",
+                            "separate.git", "separate")
+
+    def test_010_open(self):
+        repo = gitapi.Repo.open(os.path.join(self.path, "sub"))
+        self.assertEqual(repo.git_dir, os.path.join(self.top, ".git"))
+        self.assertEqual(repo.common_dir, repo.git_dir)
+        self.assertEqual(repo.work_tree, self.top)
+        self.assertFalse(repo.bare)
+        self.assertEqual(repo.git_id(), self.repo.git_id())
+
+    def test_020_worktree(self):
+        repo = gitapi.Repo.open(os.path.join(self.path, "wt"))
+        self.assertEqual(repo.git_dir,
+                         os.path.join(self.top, ".git", "worktrees", "wt"))
+        self.assertEqual(repo.common_dir, os.path.join(self.top, ".git"))
+        self.assertEqual(repo.work_tree, os.path.join(self.top, "wt"))
+
+    def test_030_bare(self):
+        repo = gitapi.Repo.open(os.path.join(self.path, "bare.git"))
+        self.assertEqual(repo.git_dir, os.path.join(self.top, "bare.git"))
+        self.assertTrue(repo.bare)
+
+    def test_040_gitfile(self):
+        repo = gitapi.Repo.open(os.path.join(self.path, "separate"))
+        self.assertEqual(repo.git_dir, os.path.join(self.top, "separate.git"))
+        self.assertEqual(repo.work_tree, os.path.join(self.top, "separate"))
+
+    def test_050_not_a_repo(self):
+        import tempfile
+        path = tempfile.mkdtemp()
+        try:
+            self.assertRaises(gitapi.GitException, gitapi.Repo.open, path)
+            repo = gitapi.Repo(path)
+            repo.git_init()
+            self.assertEqual(repo.git_dir, os.path.join(path, ".git"))
+        finally:
+            shutil.rmtree(path)
+
+    def test_055_not_a_directory(self):
+        self.assertRaises(gitapi.GitException, gitapi.Repo.open,
+                          os.path.join(self.path, "does-not-exist"))
+        self.assertRaises(gitapi.GitException, gitapi.Repo.open,
+                          os.path.join(self.path, "file.txt"))
+
+    def test_060_lazy_imports(self):
+        import subprocess, sys
+        code = ("import sys, gitapi; print(' '.join(m for m in "
+                "('json', 'urllib.parse') if m in sys.modules))")
+        out = subprocess.check_output([sys.executable, "-c", code],
+                                      cwd=os.path.dirname(
+                                          os.path.dirname(gitapi.__file__)))
+        self.assertEqual(out.strip(), b"")
+
+
+class TestMergeTree(RepoTestCase):
+    path = "./test-merge-tree"
+
+    @classmethod
+    def _commit_on(cls, branch, start, files):
+        cls.repo.git_checkout(start)
+        cls.repo.git_checkout(branch, branch=True)
+        for name, content in files.items():
+            with open(os.path.join(cls.path, name), "w") as out:
+                out.write(content)
+            cls.repo.git_add(name)
+        cls.repo.git_command("commit", "-m", branch)
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestMergeTree, cls).setUpClass()
+        cls._commit_on("ours", "master", {"file.txt": "ours"})
+        cls._commit_on("theirs", "master", {"file.txt": "theirs",
+                                            "other.txt": "other"})
+        cls._commit_on("clean", "master", {"other.txt": "other"})
+        cls.repo.git_checkout("master")
+
+    def test_010_clean(self):
+        result = self.repo.merge_tree(None, "ours", "clean")
+        self.assertTrue(result.clean)
+        self.assertEqual(result.conflicts, [])
+        self.assertEqual(self.repo.git_command(
+            "ls-tree", "--name-only", result.tree).split(),
+                         ["file.txt", "other.txt"])
+
+    def test_020_conflict(self):
+        result = self.repo.merge_tree(None, "ours", "theirs")
+        self.assertFalse(result.clean)
+        self.assertEqual([c.path for c in result.conflicts], ["file.txt"])
+        conflict = result.conflicts[0]
+        blob = lambda rev: self.repo.git_command(
+            "rev-parse", rev + ":file.txt").strip()
+        self.assertEqual(conflict.base, blob("master"))
+        self.assertEqual(conflict.ours, blob("ours"))
+        self.assertEqual(conflict.theirs, blob("theirs"))
+        self.assertEqual(conflict.types, ["CONFLICT (contents)"])
+        self.assertEqual(self.repo.git_status(), {})
+        self.assertEqual(self.repo.git_branches(),
+                         ["clean", "master", "ours", "theirs"])
+
+    def test_030_parallel(self):
+        merges = [(None, "ours", "clean"), (None, "ours", "theirs")] * 10
+        results = self.repo.merge_trees(merges, jobs=4)
+        self.assertEqual([result.clean for result in results],
+                         [True, False] * 10)
+        self.assertRaises(gitapi.GitException, self.repo.merge_trees,
+                          [(None, "ours", "missing")])
+        try:
+            self.repo.merge_tree(None, "ours", "missing")
+        except gitapi.GitException as exc:
+            self.assertTrue("missing - not something we can merge"
+                            in str(exc))
+            self.assertEqual(exc.exit_code, 1)
+        else:
+            self.fail("GitException not raised")
+
+    def test_040_base(self):
+        version = self.repo.git_command("version").split()[2]
+        if tuple(int(x) for x in version.split(".")[:2]) < (2, 40):
+            self.skipTest("git merge-tree --merge-base needs git 2.40")
+        result = self.repo.merge_tree("ours", "ours", "theirs")
+        self.assertTrue(result.clean)
+
+
+class TestSubmodules(RepoTestCase):
+    path = "./test-submodules"
+    libs = ("./test-submodules-lib1", "./test-submodules-lib2")
+    clone = gitapi.Repo("./test-submodules-clone")
+
+    @classmethod
+    def _add(cls, repo, url, path):
+        repo.git_command("submodule", "add", "-q",
+                         "file://" + os.path.abspath(url), path)
+        repo.git_command("commit", "-m", "adding " + path)
+
+    @classmethod
+    def setUpClass(cls):
+        # file:// submodules are disallowed by default since git 2.38.1
+        cls.allow_protocol = os.environ.get("GIT_ALLOW_PROTOCOL")
+        os.environ["GIT_ALLOW_PROTOCOL"] = "file"
+        for lib in reversed(cls.libs):
+            cls.path, path = lib, cls.path
+            super(TestSubmodules, cls).setUpClass()
+            cls.path = path
+        lib1 = cls.repo
+        cls._add(lib1, cls.libs[1], "nested")
+        super(TestSubmodules, cls).setUpClass()
+        cls._add(cls.repo, cls.libs[0], "libs/lib1")
+        cls._add(cls.repo, cls.libs[1], "libs/lib2")
+        cls.repo.git_command("config", "-f", ".gitmodules",
+                             "submodule.libs/lib2.branch", "master")
+        cls.repo.git_command("commit", "-am", "tracking master")
+        shutil.rmtree(cls.clone.path, ignore_errors=True)
+        gitapi.Repo.git_clone(cls.path, cls.clone.path)
+
+    @classmethod
+    def tearDownClass(cls):
+        super(TestSubmodules, cls).tearDownClass()
+        for path in cls.libs + (cls.clone.path,):
+            shutil.rmtree(path, ignore_errors=True)
+        if cls.allow_protocol is None:
+            del os.environ["GIT_ALLOW_PROTOCOL"]
+        else:
+            os.environ["GIT_ALLOW_PROTOCOL"] = cls.allow_protocol
+
+    def test_010_discover(self):
+        submodules = self.clone.submodules()
+        self.assertEqual([s.path for s in submodules],
+                         ["libs/lib1", "libs/lib2"])
+        lib2 = submodules[1]
+        self.assertEqual(lib2.name, "libs/lib2")
+        self.assertEqual(lib2.url,
+                         "file://" + os.path.abspath(self.libs[1]))
+        self.assertEqual(lib2.branch, "master")
+        self.assertEqual(lib2.node, gitapi.Repo(self.libs[1]).git_id())
+        self.assertFalse(lib2.initialized)
+        self.assertEqual(len(self.clone.submodules(recursive=True)), 2)
+
+    def test_020_update(self):
+        submodules = self.clone.update_submodules(jobs=2)
+        self.assertEqual([s.path for s in submodules],
+                         ["libs/lib1", "libs/lib2", "libs/lib1/nested"])
+        self.assertTrue(all(s.initialized for s in submodules))
+        self.assertEqual(submodules[2].repo.git_id(),
+                         gitapi.Repo(self.libs[1]).git_id())
+
+    def test_030_status(self):
+        nested = os.path.join(self.clone.path, "libs", "lib1", "nested")
+        with open(os.path.join(nested, "file.txt"), "w") as out:
+            out.write("changed")
+        status = self.clone.status_recursive(jobs=2)
+        self.assertEqual(sorted(status), ["", "libs/lib1",
+                                          "libs/lib1/nested", "libs/lib2"])
+        self.assertEqual(status["libs/lib1/nested"], {'M': ['file.txt']})
+        self.assertEqual(status["libs/lib1"], {'m': ['nested']})
+        self.assertEqual(status["libs/lib2"], {})
+
+    def test_040_fetch(self):
+        trace = os.path.abspath("./test-submodules-trace")
+        os.environ["GIT_TRACE"] = trace
+        try:
+            self.assertEqual(sorted(self.clone.fetch_recursive(jobs=2)),
+                             ["", "libs/lib1", "libs/lib1/nested",
+                              "libs/lib2"])
+        finally:
+            del os.environ["GIT_TRACE"]
+        with open(trace) as src:
+            fetches = [line for line in src
+                       if "built-in: git fetch" in line]
+        os.remove(trace)
+        self.assertEqual(len(fetches), 4)
+        self.assertTrue(all("--recurse-submodules=no" in line
+                            for line in fetches))
+
+    def test_050_fetch_failure(self):
+        lib2 = gitapi.Repo(os.path.join(self.clone.path, "libs", "lib2"))
+        lib2.git_command("remote", "set-url", "origin", "./missing")
+        try:
+            self.clone.fetch_recursive(jobs=2)
+        except gitapi.SubmoduleError as exc:
+            self.assertEqual(sorted(exc.results),
+                             ["", "libs/lib1", "libs/lib1/nested"])
+            self.assertEqual(list(exc.errors), ["libs/lib2"])
+            self.assertTrue("libs/lib2" in str(exc))
+        else:
+            self.fail("SubmoduleError not raised")
+
+    def test_060_open_subdir(self):
+        repo = gitapi.Repo.open(os.path.join(self.clone.path, "libs"))
+        self.assertEqual([s.path for s in repo.submodules()],
+                         ["libs/lib1", "libs/lib2"])
+        self.assertEqual(sorted(repo.status_recursive()),
+                         ["", "libs/lib1", "libs/lib1/nested", "libs/lib2"])
+
+    def test_070_bare(self):
+        bare = os.path.join(self.clone.path, "bare.git")
+        gitapi.Repo.git_clone(self.path, bare, "--bare")
+        self.assertEqual(gitapi.Repo.open(bare).submodules(), [])
+
+    def test_080_no_submodule_entries(self):
+        lib1 = gitapi.Repo(os.path.join(self.clone.path, "libs", "lib1"))
+        lib1.git_command("rm", "-q", "-f", "nested")
+        self.assertTrue(os.path.isfile(os.path.join(lib1.path,
+                                                    ".gitmodules")))
+        self.assertEqual(lib1.submodules(), [])
+
 def test_doc():
     #Prepare for doctest
     os.mkdir("./test_gitapi")